@@ -2,29 +2,62 @@ import os
 import threading
 import logging
 import io
-import pandas as pd
+import re
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.compute as pc
+import orjson
+import redis
 from flask import Flask, request, jsonify, render_template
+from flask.json.provider import DefaultJSONProvider
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions
 #from azure.identity import DefaultAzureCredential
 from azure.identity import ManagedIdentityCredential
 from pymongo import MongoClient
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
+class ORJSONProvider(DefaultJSONProvider):
+    """Serialize responses with orjson; jsonify call sites are unchanged."""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_SORT_KEYS if self.sort_keys else 0
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 load_dotenv()
 
 # Logging setup
 logging.basicConfig(level=logging.DEBUG)
 
-# Rate limiter setup
+# Rate limiter setup; a shared Redis backend keeps limits consistent across gunicorn workers
+ratelimit_storage_uri = os.getenv('RATELIMIT_STORAGE_URI', 'memory://')
+ratelimit_storage_options = {}
+if ratelimit_storage_uri.startswith(('redis://', 'rediss://')):
+    ratelimit_storage_options['connection_pool'] = redis.ConnectionPool.from_url(
+        ratelimit_storage_uri, max_connections=50
+    )
+elif ratelimit_storage_uri.startswith('memory://') and 'gunicorn' in os.getenv('SERVER_SOFTWARE', ''):
+    # The gunicorn arbiter sets SERVER_SOFTWARE before forking workers
+    logging.warning(
+        "RATELIMIT_STORAGE_URI is memory://; each gunicorn worker keeps its own rate limit "
+        "counters. Set RATELIMIT_STORAGE_URI to a shared Redis for consistent limits."
+    )
+
 limiter = Limiter(
     key_func=get_remote_address,
     app=app,
-    default_limits=["100 per hour"]
+    default_limits=["100 per hour"],
+    storage_uri=ratelimit_storage_uri,
+    storage_options=ratelimit_storage_options,
+    # Keep limiting per worker if the shared storage is unreachable
+    in_memory_fallback_enabled=True
 )
 
 @app.route('/health')
@@ -42,15 +75,73 @@ mongo_collection_name = os.getenv('MONGO_COLLECTION_NAME')
 mongo_generic_collection = os.getenv('GENERIC_COLLECTION_NAME')
 mongo_generic_db_name = os.getenv('MONGO_GENERIC_DB_NAME')
 
+# One pooled MongoClient per URI, shared across requests (never closed per request)
+_MONGO_CLIENTS = {
+    mongo_uri: MongoClient(mongo_uri, maxPoolSize=50, minPoolSize=5, maxIdleTimeMS=60000)
+}
+
 def get_mongo_collection(uri, db_name, collection_name):
-    client = MongoClient(uri)
-    db = client[db_name]
-    return db[collection_name]
+    return _MONGO_CLIENTS[uri][db_name][collection_name]
+
+# Indexes backing the /download lookups; create_index is a no-op when they exist
+def ensure_mongo_indexes():
+    try:
+        get_mongo_collection(mongo_uri, mongo_db_name, mongo_collection_name).create_index(
+            [('company_id', 1), ('created_on', -1)]
+        )
+        get_mongo_collection(mongo_uri, mongo_generic_db_name, mongo_generic_collection).create_index(
+            [('company_id', 1)]
+        )
+    except Exception as e:
+        logging.warning(f"Failed to ensure MongoDB indexes: {e}")
+
+# Run in the background so an unreachable MongoDB does not block startup
+threading.Thread(target=ensure_mongo_indexes, daemon=True).start()
+
+# User delegation keys are cached per account and requested for a longer window
+# than any single SAS, so one key signs every SAS until it is close to expiring
+_UDK_CACHE = {}
+_UDK_LOCKS = {}
+_UDK_LOCKS_GUARD = threading.Lock()
+_UDK_LIFETIME = timedelta(hours=1)
+
+def get_user_delegation_key(blob_service_client, account_name, now, sas_expiry):
+    # One lock per account, so a slow key refresh for one account does not block the others
+    with _UDK_LOCKS_GUARD:
+        account_lock = _UDK_LOCKS.setdefault(account_name, threading.Lock())
+
+    with account_lock:
+        cached = _UDK_CACHE.get(account_name)
+        # A SAS is only valid while its signing key is, so the key must outlive it
+        if cached and cached[1] > sas_expiry:
+            return cached[0]
+
+        key_expiry = max(now + _UDK_LIFETIME, sas_expiry)
+        delegation_key = blob_service_client.get_user_delegation_key(now, key_expiry)
+        _UDK_CACHE[account_name] = (delegation_key, key_expiry)
+        return delegation_key
+
+# Signed URLs are reused for a short absolute window so repeated requests for the
+# same blob return the same URL instead of re-signing it; oldest entries are
+# evicted once the cache is full
+_SAS_CACHE = OrderedDict()
+_SAS_LOCK = threading.Lock()
+_SAS_REUSE_WINDOW = timedelta(minutes=10)
+_SAS_MIN_REMAINING = timedelta(minutes=2)
+_SAS_CACHE_MAX_ENTRIES = 1024
 
 # Uses User Delegation SAS via Managed Identity
 def generate_sas_url(blob_service_client, account_name, container_name, blob_name, expiry_minutes=15):
-    expiry = datetime.utcnow() + timedelta(minutes=expiry_minutes)
-    delegation_key = blob_service_client.get_user_delegation_key(datetime.utcnow(), expiry)
+    # One clock read per call so the key start, SAS expiry and cache window all agree
+    now = datetime.utcnow()
+    cache_key = (account_name, container_name, blob_name, 'r', expiry_minutes)
+    with _SAS_LOCK:
+        cached = _SAS_CACHE.get(cache_key)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    expiry = now + timedelta(minutes=expiry_minutes)
+    delegation_key = get_user_delegation_key(blob_service_client, account_name, now, expiry)
 
     sas_token = generate_blob_sas(
         account_name=account_name,
@@ -61,8 +152,21 @@ def generate_sas_url(blob_service_client, account_name, container_name, blob_nam
         expiry=expiry
     )
 
-    return f"https://{account_name}.blob.core.windows.net/{container_name}/{blob_name}?{sas_token}"
+    url = ''.join((_ACCOUNT_URLS[account_name], '/', container_name, '/', blob_name, '?', sas_token))
+    reuse_until = min(now + _SAS_REUSE_WINDOW, expiry - _SAS_MIN_REMAINING)
 
+    with _SAS_LOCK:
+        _SAS_CACHE[cache_key] = (url, reuse_until)
+        _SAS_CACHE.move_to_end(cache_key)
+        while len(_SAS_CACHE) > _SAS_CACHE_MAX_ENTRIES:
+            _SAS_CACHE.popitem(last=False)
+
+    return url
+
+# Blob naming convention: ATnA blobs are expected to start with the upload_id and the
+# EAROI/MCE/CISCOIBR/BYOW blobs with the company_id, so lookups use a server-side prefix
+# listing. Blobs that carry the id elsewhere in the name are still found by a logged
+# full-container substring scan when the prefix listing returns nothing.
 app_container_mapping = {
     'ATnA': {
         'containers': [os.getenv('CONTAINER_ATnA')],
@@ -98,7 +202,31 @@ app_container_mapping = {
     }
 }
 
+# Account endpoints are formatted once here rather than on every client/SAS build
+_ACCOUNT_URLS = {
+    info['account_name']: f"https://{info['account_name']}.blob.core.windows.net"
+    for info in app_container_mapping.values()
+}
+
+# Shared pool for cheap blocking Azure calls (listings, HEADs) fanned out across containers
+_LIST_POOL = ThreadPoolExecutor(max_workers=8)
+# PALOALTO CSV downloads get their own pool so a large scan cannot queue ahead of
+# the listing work of other requests in the same worker
+_CSV_POOL = ThreadPoolExecutor(max_workers=4)
+
+def _scan_container(blob_service_client, container_name, name_starts_with=None, include=None):
+    container_client = blob_service_client.get_container_client(container_name)
+    return list(container_client.list_blobs(name_starts_with=name_starts_with, include=include))
+
+def _blob_exists(blob_service_client, container_name, blob_name):
+    try:
+        blob_service_client.get_blob_client(container_name, blob_name).get_blob_properties()
+        return True
+    except ResourceNotFoundError:
+        return False
+
 @app.route('/download', methods=['POST'])
+@limiter.limit("20/minute", override_defaults=False)
 def download_latest_files():
     app_name = request.json.get('application_name')
     company_id = request.json.get('company_id')
@@ -121,7 +249,11 @@ def download_latest_files():
 
 def handle_atna_download(blob_service_client, app_name, company_id):
     collection = get_mongo_collection(mongo_uri, mongo_db_name, mongo_collection_name)
-    latest_record = collection.find_one({'company_id': company_id}, sort=[('created_on', -1)])
+    latest_record = collection.find_one(
+        {'company_id': company_id},
+        projection={'asset_add_uploads.upload_id': 1, '_id': 0},
+        sort=[('created_on', -1)]
+    )
 
     if not latest_record or 'asset_add_uploads' not in latest_record or not latest_record['asset_add_uploads']:
         return jsonify({'error': 'No upload_id found for the given company_id'}), 404
@@ -130,35 +262,42 @@ def handle_atna_download(blob_service_client, app_name, company_id):
     container_names = app_container_mapping[app_name]['containers']
     account_name = app_container_mapping[app_name]['account_name']
 
-    for container_name in container_names:
-        container_client = blob_service_client.get_container_client(container_name)
-        for blob in container_client.list_blobs():
-            if upload_id in blob.name:
+    # Try the upload_id-prefixed naming first (see app_container_mapping), fetching only
+    # the first single-item page; fall back to a full substring scan for other names
+    for name_starts_with, results_per_page in ((upload_id, 1), (None, None)):
+        if name_starts_with is None:
+            logging.warning(f"No ATnA blob name starts with upload_id {upload_id}; falling back to a full scan")
+        for container_name in container_names:
+            container_client = blob_service_client.get_container_client(container_name)
+            blobs = container_client.list_blobs(name_starts_with=name_starts_with, results_per_page=results_per_page)
+            blob = next((b for b in blobs if upload_id in b.name), None)
+            if blob:
                 download_url = generate_sas_url(blob_service_client, account_name, container_name, blob.name)
                 return jsonify({'message': f'SAS link generated for {blob.name}', 'download_url': download_url}), 200
 
     return jsonify({'error': 'No file found matching upload_id'}), 404
 
+workbook_fields_mapping = {
+    'F5': [
+        "license_asset_summary_workbook_processed",
+        "pricing_retired_workbook_processed",
+        "pricing_active_workbook_processed"
+    ],
+    'CHECKPOINT': [
+        "orders_workbook_processed",
+        "product_list_workbook_processed"
+    ]
+}
+
 def handle_f5_checkpoint_download(blob_service_client, app_name, company_id):
     collection = get_mongo_collection(mongo_uri, mongo_generic_db_name, mongo_generic_collection)
-    record = collection.find_one({"company_id": company_id})
+    workbook_fields = workbook_fields_mapping[app_name]
+    record = collection.find_one({"company_id": company_id}, projection=workbook_fields)
 
     if not record:
         return jsonify({'error': f'No record found for company_id: {company_id}'}), 404
 
-    files_to_download = []
-    if app_name == 'F5':
-        files_to_download = [
-            record.get("license_asset_summary_workbook_processed"),
-            record.get("pricing_retired_workbook_processed"),
-            record.get("pricing_active_workbook_processed")
-        ]
-    elif app_name == 'CHECKPOINT':
-        files_to_download = [
-            record.get("orders_workbook_processed"),
-            record.get("product_list_workbook_processed")
-        ]
-
+    files_to_download = [record.get(field) for field in workbook_fields]
     files_to_download = [f for f in files_to_download if f]
     if not files_to_download:
         return jsonify({'error': 'No workbook filenames found in MongoDB record'}), 404
@@ -167,26 +306,131 @@ def handle_f5_checkpoint_download(blob_service_client, app_name, company_id):
     account_name = app_container_mapping[app_name]['account_name']
     sas_links = []
 
+    # One HEAD per (file, container) instead of a prefix listing
+    futures = {
+        (blob_name, container_name): _LIST_POOL.submit(_blob_exists, blob_service_client, container_name, blob_name)
+        for blob_name in files_to_download
+        for container_name in container_names
+    }
+
     for blob_name in files_to_download:
         for container_name in container_names:
-            container_client = blob_service_client.get_container_client(container_name)
-            blob_list = list(container_client.list_blobs(name_starts_with=blob_name))
-            for blob in blob_list:
-                if blob.name == blob_name:
-                    sas_links.append({
-                        'file': blob_name,
-                        'download_url': generate_sas_url(blob_service_client, account_name, container_name, blob_name)
-                    })
-                    break
+            if futures[(blob_name, container_name)].result():
+                sas_links.append({
+                    'file': blob_name,
+                    'download_url': generate_sas_url(blob_service_client, account_name, container_name, blob_name)
+                })
+                break
 
     if sas_links:
         return jsonify({'message': 'SAS links generated', 'files': sas_links}), 200
     else:
         return jsonify({'error': 'No matching blobs found in containers'}), 404
 
+class _ChunkStream(io.RawIOBase):
+    """Read-only file object over an iterator of byte chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = memoryview(chunk)
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+_CSV_READ_OPTIONS = pacsv.ReadOptions(block_size=256 * 1024, use_threads=False)
+# Ragged rows (e.g. a short or truncated trailing row) are skipped rather than
+# failing the whole file
+_CSV_PARSE_OPTIONS = pacsv.ParseOptions(invalid_row_handler=lambda row: 'skip')
+
+def _blob_matches_csp_acct(container_client, blob_name, csp_acct_name):
+    blob_client = container_client.get_blob_client(blob_name)
+    try:
+        # Stream the blob chunk by chunk and stop downloading at the first match
+        stream = io.BufferedReader(_ChunkStream(blob_client.download_blob().chunks()))
+        # Only the account column is parsed, straight into Arrow string arrays. The reader
+        # prefetches up to 32 blocks in the background, so small blocks keep that
+        # read-ahead (and what is downloaded past a match) to a few MiB
+        reader = pacsv.open_csv(
+            stream,
+            read_options=_CSV_READ_OPTIONS,
+            parse_options=_CSV_PARSE_OPTIONS,
+            convert_options=pacsv.ConvertOptions(
+                include_columns=['CSP Acct Name'],
+                column_types={'CSP Acct Name': pa.string()}
+            )
+        )
+        for batch in reader:
+            accounts = pc.utf8_lower(pc.utf8_trim_whitespace(batch.column(0)))
+            if pc.any(pc.equal(accounts, csp_acct_name)).as_py():
+                return True
+        return False
+    except KeyError:
+        # No 'CSP Acct Name' column in this file
+        return False
+    except Exception as e:
+        logging.warning(f"Failed to process blob {blob_name}: {e}")
+    return False
+
+# PALOALTO CSVs are tagged at upload time with the lower-cased account they contain:
+#   blob_client.set_blob_tags({"csp_acct_name": csp_acct_name.strip().lower()})
+# which lets the blob index answer the lookup without downloading any file.
+# A single tag can only name one account, while a CSV may list several, so a tag is
+# only trusted for positive matches. The index is used on its own only when
+# PALOALTO_TAGS_BACKFILLED is set, which requires every file to be tagged and to
+# hold exactly one account.
+paloalto_tags_backfilled = os.getenv('PALOALTO_TAGS_BACKFILLED', '').lower() in ('1', 'true', 'yes')
+
+# Characters Azure accepts in a blob tag value; anything else can never be tagged
+_TAG_VALUE_PATTERN = re.compile(r'[A-Za-z0-9 +\-./:=_]{1,256}')
+
+# Returns None when the tag index cannot answer, so the caller falls back to a scan
+def find_paloalto_blobs_by_tag(blob_service_client, container_names, csp_acct_name):
+    if not _TAG_VALUE_PATTERN.fullmatch(csp_acct_name):
+        return None
+
+    try:
+        tagged = blob_service_client.find_blobs_by_tags(f"csp_acct_name = '{csp_acct_name}'")
+        return [(blob.container_name, blob.name) for blob in tagged if blob.container_name in container_names]
+    except HttpResponseError as e:
+        logging.warning(f"Blob tag query failed, falling back to a scan: {e}")
+        return None
+
+# Listing-based lookup: blobs tagged with the requested account match without a
+# download; every other CSV is downloaded and inspected
+def scan_paloalto_blobs(blob_service_client, container_names, csp_acct_name):
+    listings = [
+        (container_name, _LIST_POOL.submit(_scan_container, blob_service_client, container_name, include=['tags']))
+        for container_name in container_names
+    ]
+
+    matches = []
+    checks = []
+    for container_name, listing in listings:
+        container_client = blob_service_client.get_container_client(container_name)
+        for blob in listing.result():
+            if (blob.tags or {}).get('csp_acct_name') == csp_acct_name:
+                matches.append((container_name, blob.name))
+                continue
+            checks.append((container_name, blob.name, _CSV_POOL.submit(
+                _blob_matches_csp_acct, container_client, blob.name, csp_acct_name
+            )))
+
+    return matches + [(container_name, blob_name) for container_name, blob_name, check in checks if check.result()]
+
 def handle_paloalto_download(blob_service_client, app_name, company_id):
     collection = get_mongo_collection(mongo_uri, mongo_generic_db_name, mongo_generic_collection)
-    record = collection.find_one({"company_id": company_id})
+    record = collection.find_one({"company_id": company_id}, projection=['connection_details.csp_acct_name'])
 
     if not record:
         return jsonify({'error': f'No record found for company_id: {company_id}'}), 404
@@ -198,46 +442,55 @@ def handle_paloalto_download(blob_service_client, app_name, company_id):
     csp_acct_name = connection_details[0].get("csp_acct_name").strip().lower()
     container_names = app_container_mapping[app_name]['containers']
     account_name = app_container_mapping[app_name]['account_name']
-    matching_files = []
 
-    for container_name in container_names:
-        container_client = blob_service_client.get_container_client(container_name)
-        for blob in container_client.list_blobs():
-            blob_client = container_client.get_blob_client(blob.name)
-            try:
-                blob_data = blob_client.download_blob(max_concurrency=1).readall()
-                df = pd.read_csv(io.BytesIO(blob_data), dtype=str)
-                if 'CSP Acct Name' in df.columns:
-                    df['CSP Acct Name'] = df['CSP Acct Name'].astype(str).str.strip().str.lower()
-                    if csp_acct_name in df['CSP Acct Name'].values:
-                        matching_files.append({
-                            'file': blob.name,
-                            'download_url': generate_sas_url(blob_service_client, account_name, container_name, blob.name)
-                        })
-            except Exception as e:
-                logging.warning(f"Failed to process blob {blob.name}: {e}")
+    matches = None
+    if paloalto_tags_backfilled:
+        matches = find_paloalto_blobs_by_tag(blob_service_client, container_names, csp_acct_name)
+    if matches is None:
+        matches = scan_paloalto_blobs(blob_service_client, container_names, csp_acct_name)
+
+    matching_files = [
+        {
+            'file': blob_name,
+            'download_url': generate_sas_url(blob_service_client, account_name, container_name, blob_name)
+        }
+        for container_name, blob_name in matches
+    ]
 
     if matching_files:
         return jsonify({'message': 'SAS links generated', 'files': matching_files}), 200
     else:
         return jsonify({'message': 'No matching data found'}), 200
 
-def handle_latest_blob_download(blob_service_client, app_name, company_id):
-    container_names = app_container_mapping[app_name]['containers']
-    account_name = app_container_mapping[app_name]['account_name']
+def find_latest_blob(blob_service_client, container_names, company_id, name_starts_with=None):
+    futures = [
+        (container_name, _LIST_POOL.submit(
+            _scan_container, blob_service_client, container_name, name_starts_with=name_starts_with
+        ))
+        for container_name in container_names
+    ]
 
     latest_blob = None
     latest_container = None
-
-    for container_name in container_names:
-        container_client = blob_service_client.get_container_client(container_name)
-        blobs = list(container_client.list_blobs())
-        matching = [b for b in blobs if company_id in b.name]
+    for container_name, future in futures:
+        matching = [b for b in future.result() if company_id in b.name]
         if matching:
             most_recent = max(matching, key=lambda b: b.last_modified)
             if not latest_blob or most_recent.last_modified > latest_blob.last_modified:
                 latest_blob = most_recent
                 latest_container = container_name
+    return latest_blob, latest_container
+
+def handle_latest_blob_download(blob_service_client, app_name, company_id):
+    container_names = app_container_mapping[app_name]['containers']
+    account_name = app_container_mapping[app_name]['account_name']
+
+    # Try the company_id-prefixed naming first (see app_container_mapping), then fall
+    # back to a full substring scan for blobs named some other way
+    latest_blob, latest_container = find_latest_blob(blob_service_client, container_names, company_id, company_id)
+    if not latest_blob:
+        logging.warning(f"No {app_name} blob name starts with company_id {company_id}; falling back to a full scan")
+        latest_blob, latest_container = find_latest_blob(blob_service_client, container_names, company_id)
 
     if not latest_blob:
         return jsonify({'message': 'No files found for company_id'}), 200
@@ -249,16 +502,36 @@ def handle_latest_blob_download(blob_service_client, app_name, company_id):
         logging.error(f"Failed to generate SAS URL: {e}")
         return jsonify({'error': 'Failed to generate download link'}), 500
 
-def get_blob_service_client(app_name):
-    info = app_container_mapping[app_name]
-    client_id = "9add19d3-89e3-4363-8124-8f9b60da9a4e"
-    credential = ManagedIdentityCredential(client_id=client_id)
-    return BlobServiceClient(
-        account_url=f"https://{info['account_name']}.blob.core.windows.net",
-        credential=credential
-    )
-
+# Shared credential and per-app BlobServiceClient cache, so the managed identity
+# token cache and the SDK connection pool are reused across requests
+_CREDENTIAL = ManagedIdentityCredential(
+    client_id=os.getenv('AZURE_MI_CLIENT_ID', "9add19d3-89e3-4363-8124-8f9b60da9a4e")
+)
 
+_BSC_CACHE = {}
+_BSC_LOCK = threading.Lock()
 
+def get_blob_service_client(app_name):
+    client = _BSC_CACHE.get(app_name)
+    if client is not None:
+        return client
+
+    # Double-checked so concurrent first requests build only one client and pool
+    with _BSC_LOCK:
+        client = _BSC_CACHE.get(app_name)
+        if client is None:
+            client = BlobServiceClient(
+                account_url=_ACCOUNT_URLS[app_container_mapping[app_name]['account_name']],
+                credential=_CREDENTIAL,
+                # Bound each GET so streamed downloads hold at most one chunk in memory
+                max_single_get_size=4 * 1024 * 1024,
+                max_chunk_get_size=4 * 1024 * 1024
+            )
+            _BSC_CACHE[app_name] = client
+        return client
+
+
+
+# Local development only; production runs under gunicorn (see gunicorn.conf.py)
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,16 @@
+import os
+
+bind = "0.0.0.0:5000"
+
+# Processes for CPU-bound work, threads within each worker for blocking Mongo/Azure I/O.
+# Each worker holds its own Mongo/Redis pools and executor threads, so size it from
+# GUNICORN_WORKERS (match the container CPU quota) rather than the host's core count;
+# the CPU affinity set is only a fallback.
+workers = int(os.getenv('GUNICORN_WORKERS', len(os.sched_getaffinity(0))))
+worker_class = "gthread"
+threads = 8
+timeout = 120
+
+# PyMongo clients are not fork-safe, so the app (and with it the MongoClient,
+# BlobServiceClient and thread pool caches) is imported in each worker after fork
+preload_app = False
@@ -0,0 +1,435 @@
+import base64
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from unittest import mock
+
+import pytest
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.storage.blob import UserDelegationKey
+
+import app
+
+ACCOUNT = 'testaccount'
+
+
+def make_container_client(data, chunk_size=64 * 1024, consumed=None):
+    def chunks():
+        for start in range(0, len(data), chunk_size):
+            if consumed is not None:
+                consumed.append(start)
+            yield data[start:start + chunk_size]
+
+    blob_client = mock.Mock()
+    blob_client.download_blob.return_value.chunks.side_effect = chunks
+    container_client = mock.Mock()
+    container_client.get_blob_client.return_value = blob_client
+    return container_client
+
+
+def make_delegation_key():
+    key = UserDelegationKey()
+    key.signed_oid = key.signed_tid = 'test'
+    key.signed_start = key.signed_expiry = '2026-01-01T00:00:00Z'
+    key.signed_service = 'b'
+    key.signed_version = '2020-02-10'
+    key.value = base64.b64encode(b'k' * 32).decode()
+    return key
+
+
+def frozen_utcnow(now):
+    class FrozenDatetime(datetime):
+        @classmethod
+        def utcnow(cls):
+            return now
+
+    return mock.patch.object(app, 'datetime', FrozenDatetime)
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    app._UDK_CACHE.clear()
+    app._SAS_CACHE.clear()
+    with mock.patch.dict(app._ACCOUNT_URLS, {ACCOUNT: f"https://{ACCOUNT}.blob.core.windows.net"}):
+        yield
+
+
+@pytest.fixture
+def blob_service_client():
+    client = mock.Mock()
+    client.get_user_delegation_key.return_value = make_delegation_key()
+    return client
+
+
+def test_chunk_stream_reads_across_chunk_boundaries():
+    stream = app._ChunkStream([b'ab', b'', b'cde', b'f'])
+    assert stream.read() == b'abcdef'
+
+
+def test_blob_matches_csp_acct_normalises_case_and_whitespace():
+    data = b"id,CSP Acct Name\n1, Other \n2,  ACME Corp \n"
+    assert app._blob_matches_csp_acct(make_container_client(data), 'blob.csv', 'acme corp')
+
+
+def test_blob_matches_csp_acct_no_match():
+    data = b"id,CSP Acct Name\n1,other\n2,another\n"
+    assert not app._blob_matches_csp_acct(make_container_client(data), 'blob.csv', 'acme corp')
+
+
+def test_blob_matches_csp_acct_skips_ragged_rows():
+    data = b"id,CSP Acct Name\n1\n2,acme corp\n3,other,extra\n4,tr"
+    assert app._blob_matches_csp_acct(make_container_client(data), 'blob.csv', 'acme corp')
+
+
+def test_blob_matches_csp_acct_missing_column():
+    data = b"id,name\n1,acme corp\n"
+    assert not app._blob_matches_csp_acct(make_container_client(data), 'blob.csv', 'acme corp')
+
+
+def test_blob_matches_csp_acct_empty_blob():
+    assert not app._blob_matches_csp_acct(make_container_client(b""), 'blob.csv', 'acme corp')
+
+
+def test_blob_matches_csp_acct_stops_downloading_at_first_match():
+    # Well past the reader's background read-ahead of 32 blocks
+    rows = b"other\n" * 8000000
+    data = b"CSP Acct Name\nacme corp\n" + rows
+    consumed = []
+    container_client = make_container_client(data, consumed=consumed)
+
+    assert app._blob_matches_csp_acct(container_client, 'blob.csv', 'acme corp')
+    assert len(consumed) < len(range(0, len(data), 64 * 1024)) // 2
+
+
+def test_user_delegation_key_reused_while_it_outlives_the_sas(blob_service_client):
+    now = datetime(2026, 1, 1, 12, 0)
+    first = app.get_user_delegation_key(blob_service_client, ACCOUNT, now, now + timedelta(minutes=15))
+    later = now + timedelta(minutes=30)
+    second = app.get_user_delegation_key(blob_service_client, ACCOUNT, later, later + timedelta(minutes=15))
+
+    assert first is second
+    blob_service_client.get_user_delegation_key.assert_called_once_with(now, now + app._UDK_LIFETIME)
+
+
+def test_user_delegation_key_refreshed_when_sas_would_outlive_it(blob_service_client):
+    now = datetime(2026, 1, 1, 12, 0)
+    app.get_user_delegation_key(blob_service_client, ACCOUNT, now, now + timedelta(minutes=15))
+    later = now + timedelta(minutes=50)
+    app.get_user_delegation_key(blob_service_client, ACCOUNT, later, later + timedelta(minutes=15))
+
+    assert blob_service_client.get_user_delegation_key.call_count == 2
+    assert app._UDK_CACHE[ACCOUNT][1] == later + app._UDK_LIFETIME
+
+
+def test_user_delegation_key_cached_per_account(blob_service_client):
+    now = datetime(2026, 1, 1, 12, 0)
+    app.get_user_delegation_key(blob_service_client, ACCOUNT, now, now + timedelta(minutes=15))
+    app.get_user_delegation_key(blob_service_client, 'otheraccount', now, now + timedelta(minutes=15))
+
+    assert blob_service_client.get_user_delegation_key.call_count == 2
+
+
+def test_sas_url_reused_within_window(blob_service_client):
+    now = datetime(2026, 1, 1, 12, 0)
+    with frozen_utcnow(now):
+        first = app.generate_sas_url(blob_service_client, ACCOUNT, 'container', 'blob.csv')
+    with frozen_utcnow(now + timedelta(minutes=9)):
+        second = app.generate_sas_url(blob_service_client, ACCOUNT, 'container', 'blob.csv')
+
+    assert first == second
+    assert first.startswith(f"https://{ACCOUNT}.blob.core.windows.net/container/blob.csv?")
+
+
+def test_sas_url_resigned_after_window(blob_service_client):
+    now = datetime(2026, 1, 1, 12, 0)
+    with frozen_utcnow(now):
+        first = app.generate_sas_url(blob_service_client, ACCOUNT, 'container', 'blob.csv')
+    with frozen_utcnow(now + timedelta(minutes=10)):
+        second = app.generate_sas_url(blob_service_client, ACCOUNT, 'container', 'blob.csv')
+
+    assert first != second
+
+
+def test_sas_url_reuse_leaves_minimum_lifetime(blob_service_client):
+    now = datetime(2026, 1, 1, 12, 0)
+    with frozen_utcnow(now):
+        first = app.generate_sas_url(blob_service_client, ACCOUNT, 'container', 'blob.csv', expiry_minutes=5)
+    with frozen_utcnow(now + timedelta(minutes=3)):
+        second = app.generate_sas_url(blob_service_client, ACCOUNT, 'container', 'blob.csv', expiry_minutes=5)
+
+    assert first != second
+
+
+def test_sas_url_cache_keyed_on_expiry_minutes(blob_service_client):
+    now = datetime(2026, 1, 1, 12, 0)
+    with frozen_utcnow(now):
+        short = app.generate_sas_url(blob_service_client, ACCOUNT, 'container', 'blob.csv', expiry_minutes=15)
+        long = app.generate_sas_url(blob_service_client, ACCOUNT, 'container', 'blob.csv', expiry_minutes=60)
+
+    assert short != long
+
+
+def test_sas_url_cache_evicts_oldest_entries(blob_service_client):
+    now = datetime(2026, 1, 1, 12, 0)
+    with frozen_utcnow(now), mock.patch.object(app, '_SAS_CACHE_MAX_ENTRIES', 2):
+        for name in ('a.csv', 'b.csv', 'c.csv'):
+            app.generate_sas_url(blob_service_client, ACCOUNT, 'container', name)
+
+    assert [key[2] for key in app._SAS_CACHE] == ['b.csv', 'c.csv']
+
+
+def make_blob(name, last_modified=None, tags=None):
+    blob = mock.Mock()
+    blob.name = name
+    blob.last_modified = last_modified
+    blob.tags = tags
+    return blob
+
+
+def make_listing_client(blobs):
+    def list_blobs(name_starts_with=None, **kwargs):
+        return [b for b in blobs if name_starts_with is None or b.name.startswith(name_starts_with)]
+
+    client = mock.Mock()
+    client.get_container_client.return_value.list_blobs.side_effect = list_blobs
+    return client
+
+
+@pytest.fixture
+def flask_app_context():
+    with app.app.app_context():
+        yield
+
+
+def test_atna_download_uses_prefix_listing(flask_app_context):
+    collection = mock.Mock()
+    collection.find_one.return_value = {'asset_add_uploads': [{'upload_id': 'up1'}]}
+    client = make_listing_client([make_blob('up1_assets.xlsx')])
+
+    with mock.patch.object(app, 'get_mongo_collection', return_value=collection), \
+            mock.patch.object(app, 'generate_sas_url', return_value='URL'):
+        response, status = app.handle_atna_download(client, 'ATnA', 'c1')
+
+    assert status == 200
+    assert response.json['download_url'] == 'URL'
+    list_blobs = client.get_container_client.return_value.list_blobs
+    assert list_blobs.call_args_list == [mock.call(name_starts_with='up1', results_per_page=1)]
+
+
+def test_atna_download_falls_back_to_substring_scan(flask_app_context):
+    collection = mock.Mock()
+    collection.find_one.return_value = {'asset_add_uploads': [{'upload_id': 'up1'}]}
+    client = make_listing_client([make_blob('other.xlsx'), make_blob('assets_up1.xlsx')])
+
+    with mock.patch.object(app, 'get_mongo_collection', return_value=collection), \
+            mock.patch.object(app, 'generate_sas_url', return_value='URL'):
+        response, status = app.handle_atna_download(client, 'ATnA', 'c1')
+
+    assert status == 200
+    assert response.json['message'] == 'SAS link generated for assets_up1.xlsx'
+
+
+def test_latest_blob_prefers_prefix_listing():
+    client = make_listing_client([
+        make_blob('c1_old.csv', datetime(2026, 1, 1)),
+        make_blob('c1_new.csv', datetime(2026, 2, 1)),
+    ])
+
+    blob, container = app.find_latest_blob(client, ['container'], 'c1', 'c1')
+
+    assert (blob.name, container) == ('c1_new.csv', 'container')
+
+
+def test_latest_blob_download_falls_back_to_substring_scan(flask_app_context):
+    client = make_listing_client([
+        make_blob('report_c1_old.csv', datetime(2026, 1, 1)),
+        make_blob('report_c1_new.csv', datetime(2026, 2, 1)),
+        make_blob('report_c2.csv', datetime(2026, 3, 1)),
+    ])
+
+    with mock.patch.dict(app.app_container_mapping, {'MCE': {'containers': ['container'], 'account_name': ACCOUNT}}), \
+            mock.patch.object(app, 'generate_sas_url', return_value='URL'):
+        response, status = app.handle_latest_blob_download(client, 'MCE', 'c1')
+
+    assert status == 200
+    assert response.json['message'] == 'Download link for report_c1_new.csv generated'
+
+
+def test_scan_paloalto_blobs_trusts_tags_only_for_positive_matches():
+    client = make_listing_client([
+        make_blob('tagged_match.csv', tags={'csp_acct_name': 'acme'}),
+        make_blob('tagged_other.csv', tags={'csp_acct_name': 'other'}),
+        make_blob('untagged.csv'),
+    ])
+    downloaded = {'tagged_other.csv': True, 'untagged.csv': False}
+
+    with mock.patch.object(app, '_blob_matches_csp_acct', side_effect=lambda cc, name, acct: downloaded[name]) as check:
+        matches = app.scan_paloalto_blobs(client, ['container'], 'acme')
+
+    assert matches == [('container', 'tagged_match.csv'), ('container', 'tagged_other.csv')]
+    assert sorted(c.args[1] for c in check.call_args_list) == ['tagged_other.csv', 'untagged.csv']
+
+
+def make_filtered_blob(container_name, name):
+    blob = mock.Mock()
+    blob.container_name = container_name
+    blob.name = name
+    return blob
+
+
+def test_find_paloalto_blobs_by_tag_filters_to_app_containers():
+    client = mock.Mock()
+    client.find_blobs_by_tags.return_value = [
+        make_filtered_blob('container', 'a.csv'),
+        make_filtered_blob('elsewhere', 'b.csv'),
+    ]
+
+    matches = app.find_paloalto_blobs_by_tag(client, ['container'], 'acme corp')
+
+    assert matches == [('container', 'a.csv')]
+    client.find_blobs_by_tags.assert_called_once_with("csp_acct_name = 'acme corp'")
+
+
+def test_find_paloalto_blobs_by_tag_skips_untaggable_values():
+    client = mock.Mock()
+
+    assert app.find_paloalto_blobs_by_tag(client, ['container'], "o'reilly") is None
+    client.find_blobs_by_tags.assert_not_called()
+
+
+def test_find_paloalto_blobs_by_tag_returns_none_on_query_error():
+    def failing_pages(filter_expression):
+        raise HttpResponseError('This request is not authorized')
+        yield
+
+    client = mock.Mock()
+    client.find_blobs_by_tags.side_effect = failing_pages
+
+    assert app.find_paloalto_blobs_by_tag(client, ['container'], 'acme') is None
+
+
+def test_paloalto_download_falls_back_to_scan_when_tag_index_cannot_answer(flask_app_context):
+    collection = mock.Mock()
+    collection.find_one.return_value = {'connection_details': [{'csp_acct_name': ' ACME '}]}
+
+    with mock.patch.object(app, 'get_mongo_collection', return_value=collection), \
+            mock.patch.object(app, 'paloalto_tags_backfilled', True), \
+            mock.patch.object(app, 'find_paloalto_blobs_by_tag', return_value=None) as by_tag, \
+            mock.patch.object(app, 'scan_paloalto_blobs', return_value=[('container', 'a.csv')]) as scan, \
+            mock.patch.object(app, 'generate_sas_url', return_value='URL'):
+        response, status = app.handle_paloalto_download(mock.Mock(), 'PALOALTO', 'c1')
+
+    assert status == 200
+    assert response.json['files'] == [{'file': 'a.csv', 'download_url': 'URL'}]
+    assert by_tag.call_args.args[2] == 'acme'
+    scan.assert_called_once()
+
+
+def test_blob_exists():
+    client = mock.Mock()
+    assert app._blob_exists(client, 'container', 'a.xlsx')
+    client.get_blob_client.assert_called_once_with('container', 'a.xlsx')
+
+    client.get_blob_client.return_value.get_blob_properties.side_effect = ResourceNotFoundError('missing')
+    assert not app._blob_exists(client, 'container', 'a.xlsx')
+
+
+def test_f5_download_returns_first_container_holding_each_workbook(flask_app_context):
+    collection = mock.Mock()
+    collection.find_one.return_value = {
+        '_id': 1,
+        'license_asset_summary_workbook_processed': 'license.xlsx',
+        'pricing_active_workbook_processed': 'active.xlsx',
+    }
+    present = {('second', 'license.xlsx'), ('first', 'active.xlsx'), ('second', 'active.xlsx')}
+
+    with mock.patch.dict(app.app_container_mapping, {'F5': {'containers': ['first', 'second'], 'account_name': ACCOUNT}}), \
+            mock.patch.object(app, 'get_mongo_collection', return_value=collection), \
+            mock.patch.object(app, '_blob_exists', side_effect=lambda bsc, cn, name: (cn, name) in present), \
+            mock.patch.object(app, 'generate_sas_url', side_effect=lambda bsc, acct, cn, name: f'{cn}/{name}'):
+        response, status = app.handle_f5_checkpoint_download(mock.Mock(), 'F5', 'c1')
+
+    assert status == 200
+    assert response.json['files'] == [
+        {'file': 'license.xlsx', 'download_url': 'second/license.xlsx'},
+        {'file': 'active.xlsx', 'download_url': 'first/active.xlsx'},
+    ]
+
+
+@pytest.mark.parametrize('app_name', ['F5', 'CHECKPOINT'])
+def test_f5_checkpoint_download_projects_workbook_fields(flask_app_context, app_name):
+    collection = mock.Mock()
+    collection.find_one.return_value = {'_id': 1}
+
+    with mock.patch.object(app, 'get_mongo_collection', return_value=collection):
+        response, status = app.handle_f5_checkpoint_download(mock.Mock(), app_name, 'c1')
+
+    collection.find_one.assert_called_once_with(
+        {'company_id': 'c1'}, projection=app.workbook_fields_mapping[app_name]
+    )
+    # _id is kept, so an existing record without workbooks is told apart from a missing one
+    assert status == 404
+    assert response.json['error'] == 'No workbook filenames found in MongoDB record'
+
+
+def test_atna_download_projects_upload_ids(flask_app_context):
+    collection = mock.Mock()
+    collection.find_one.return_value = None
+
+    with mock.patch.object(app, 'get_mongo_collection', return_value=collection):
+        app.handle_atna_download(mock.Mock(), 'ATnA', 'c1')
+
+    collection.find_one.assert_called_once_with(
+        {'company_id': 'c1'},
+        projection={'asset_add_uploads.upload_id': 1, '_id': 0},
+        sort=[('created_on', -1)]
+    )
+
+
+def test_paloalto_download_projects_csp_acct_name(flask_app_context):
+    collection = mock.Mock()
+    collection.find_one.return_value = {'_id': 1}
+
+    with mock.patch.object(app, 'get_mongo_collection', return_value=collection):
+        response, status = app.handle_paloalto_download(mock.Mock(), 'PALOALTO', 'c1')
+
+    collection.find_one.assert_called_once_with(
+        {'company_id': 'c1'}, projection=['connection_details.csp_acct_name']
+    )
+    assert status == 404
+    assert response.json['error'] == 'No csp_acct_name found'
+
+
+def test_ensure_mongo_indexes():
+    collection = mock.Mock()
+
+    with mock.patch.object(app, 'get_mongo_collection', return_value=collection):
+        app.ensure_mongo_indexes()
+
+    assert collection.create_index.call_args_list == [
+        mock.call([('company_id', 1), ('created_on', -1)]),
+        mock.call([('company_id', 1)]),
+    ]
+
+
+def test_blob_service_client_built_once_under_concurrent_first_requests():
+    barrier = threading.Barrier(8)
+
+    def slow_client(**kwargs):
+        time.sleep(0.05)
+        return mock.Mock(**kwargs)
+
+    with mock.patch.dict(app._BSC_CACHE, clear=True), \
+            mock.patch.dict(app.app_container_mapping, {'F5': {'containers': [], 'account_name': ACCOUNT}}), \
+            mock.patch.object(app, 'BlobServiceClient', side_effect=slow_client) as constructor:
+        def first_request():
+            barrier.wait()
+            return app.get_blob_service_client('F5')
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            clients = list(pool.map(lambda _: first_request(), range(8)))
+
+    assert constructor.call_count == 1
+    assert all(client is clients[0] for client in clients)
+    assert constructor.call_args.kwargs['account_url'] == f"https://{ACCOUNT}.blob.core.windows.net"